@@ -1,32 +1,44 @@
+import asyncio
 from typing import Annotated
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, Depends, Request, status, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
 from fastapi.staticfiles import StaticFiles
+from sqlalchemy import func, insert
+from sqlalchemy.orm import aliased
 from sqlmodel import Session, select
 
 from lib.api_models import Position
 from lib.constants import ORIGINS, WHITELIST as IP_WHITELIST
-from lib.db import get_session, create_db_and_tables, AccountSnapshot, Order
-from lib.env_vars import get_accounts, TEST_MODE
-from lib.utils import (exec_trade, get_client_ip, get_current_position, close_position, get_latest_quote,
-                       get_trading_client, is_extended_hours, get_trading_clients)
+from lib.db import get_session, create_db_and_tables, save, insert_row, AccountSnapshot, Order
+from lib.env_vars import get_accounts, TEST_MODE, ORDER_STREAMS
+from lib.order_updates import start_order_streams, stop_order_streams
+from lib.utils import (exec_trade, get_client_ip, get_current_position, close_position, get_cached_quote,
+                       get_trading_client, is_extended_hours, get_trading_clients, get_account_view)
 
 
 SessionDep = Annotated[Session, Depends(get_session)]
 
+SNAPSHOTS_PER_ACCOUNT = 12
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     '''Creates a lifespan for items that should be run at startup and shutdown.
 Startup tasks should be placed before the yield, and shutdown tasks should be placed after the yield.'''
     create_db_and_tables()
+    # no orders are sent in test mode, so there's nothing to listen for
+    if ORDER_STREAMS and not TEST_MODE:
+        start_order_streams()
     yield
+    await stop_order_streams()
 
 
-app = FastAPI(name="Webhook Trader", lifespan=lifespan)
+app = FastAPI(name="Webhook Trader", lifespan=lifespan,
+              default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -39,17 +51,20 @@ app.add_middleware(
 
 def background_snapshot(session: Session, exclude: list[str] = []):
     clients = get_trading_clients()
+    snapshots = []
     for name, client in clients.items():
         if name in exclude:
             continue
         account = client.get_account()
-        snapshot = AccountSnapshot(
+        snapshots.append(AccountSnapshot(
             account_id=str(account.id),
             name=name,
             cash=float(account.cash),
             equity=float(account.equity),
-        )
-        session.add(snapshot)
+        ).model_dump(exclude={"id"}))
+    if not snapshots:
+        return
+    session.execute(insert(AccountSnapshot), snapshots)
     session.commit()
 
 
@@ -58,18 +73,25 @@ async def get_account(name: str):
     client = get_trading_client(name)
     if not client:
         # return a 404
-        return JSONResponse(content={"error": "Account not found"}, status_code=status.HTTP_404_NOT_FOUND)
-    account = client.get_account()
+        return ORJSONResponse(content={"error": "Account not found"}, status_code=status.HTTP_404_NOT_FOUND)
+    account = await run_in_threadpool(client.get_account)
     return account
 
 
 @app.get("/snapshots", response_model=list[AccountSnapshot])
 async def get_snapshots(session: SessionDep):
     # Get the last 12 snapshots for each account
-    limit = 12 * len(get_accounts())
-    statement = select(AccountSnapshot).order_by(
-        AccountSnapshot.created_at.desc()).limit(limit)
-    snapshots = session.exec(statement).all()
+    ranked = select(
+        AccountSnapshot,
+        func.row_number().over(
+            partition_by=AccountSnapshot.name,
+            order_by=AccountSnapshot.created_at.desc()
+        ).label("rank")
+    ).subquery()
+    snapshot = aliased(AccountSnapshot, ranked)
+    statement = select(snapshot).where(
+        ranked.c.rank <= SNAPSHOTS_PER_ACCOUNT).order_by(ranked.c.created_at.desc())
+    snapshots = await run_in_threadpool(lambda: session.exec(statement).all())
 
     return snapshots
 
@@ -79,16 +101,14 @@ async def get_snapshot(name: str, session: SessionDep, background_task: Backgrou
     # create and return a snapshot for the account
     # save the new snapshot to the database
     client = get_trading_client(name)
-    account = client.get_account()
+    account = await run_in_threadpool(client.get_account)
     snapshot = AccountSnapshot(
         account_id=str(account.id),
         name=name,
         cash=float(account.cash),
         equity=float(account.equity),
     )
-    session.add(snapshot)
-    session.commit()
-    session.refresh(snapshot)
+    await insert_row(session, snapshot)
     background_task.add_task(
         background_snapshot, session=session, exclude=[name])
     return snapshot
@@ -98,11 +118,11 @@ async def get_snapshot(name: str, session: SessionDep, background_task: Backgrou
 async def positions(name: str, req: Request):
     ip = get_client_ip(req)
     if type(ip) is str and ip not in IP_WHITELIST:
-        return JSONResponse(content={"error": f"IP '{ip}' not in whitelist"}, status_code=status.HTTP_401_UNAUTHORIZED)
+        return ORJSONResponse(content={"error": f"IP '{ip}' not in whitelist"}, status_code=status.HTTP_401_UNAUTHORIZED)
     elif type(ip) is list and all(x not in IP_WHITELIST for x in ip):
-        return JSONResponse(content={"error": f"IPs '{ip}' not in whitelist"}, status_code=status.HTTP_401_UNAUTHORIZED)
+        return ORJSONResponse(content={"error": f"IPs '{ip}' not in whitelist"}, status_code=status.HTTP_401_UNAUTHORIZED)
     client = get_trading_client(name)
-    alpaca_positions = client.get_all_positions()
+    alpaca_positions = await run_in_threadpool(client.get_all_positions)
     positions = [Position.from_alpaca(p) for p in alpaca_positions]
     return positions
 
@@ -113,57 +133,58 @@ async def webhook(name: str, order: Order, session: SessionDep, req: Request, ba
     ip = get_client_ip(req)
 
     if type(ip) is str and ip not in IP_WHITELIST:
-        return JSONResponse(content={"error": f"IP '{ip}' not in whitelist"}, status_code=status.HTTP_401_UNAUTHORIZED)
+        return ORJSONResponse(content={"error": f"IP '{ip}' not in whitelist"}, status_code=status.HTTP_401_UNAUTHORIZED)
     elif type(ip) is list and all(x not in IP_WHITELIST for x in ip):
-        return JSONResponse(content={"error": f"IPs '{ip}' not in whitelist"}, status_code=status.HTTP_401_UNAUTHORIZED)
+        return ORJSONResponse(content={"error": f"IPs '{ip}' not in whitelist"}, status_code=status.HTTP_401_UNAUTHORIZED)
 
     if not order.nickname:
         order.nickname = name
     if not order.max_slippage:
         order.max_slippage = 0
     # log the order
-    session.add(order)
-    session.commit()
+    await insert_row(session, order)
     # if we're in test mode, we're done. Echo the order back.
     if TEST_MODE:
-        session.refresh(order)
         return order
 
     print(get_accounts().keys())
     # otherwise, we need to forward to alpaca and add the order ID to the order
     client = get_trading_client(name)
     if not client:
-        return JSONResponse(content={"error": f"Account '{name}' not found"}, status_code=status.HTTP_404_NOT_FOUND)
+        return ORJSONResponse(content={"error": f"Account '{name}' not found"}, status_code=status.HTTP_404_NOT_FOUND)
     # the webhooks should only fire if we're in extended hours or the market is open
     # so we don't need to check if we can trade
     # we do need to check if we're in extended hours, as the order type will be different
-    extended_hours = is_extended_hours(client)
+    # none of these lookups depend on each other, so fetch them concurrently
+    extended_hours, account, position = await asyncio.gather(
+        is_extended_hours(client),
+        get_account_view(client),
+        get_current_position(client, order.ticker),
+    )
 
     # check if we've hit 3 day trades with equity under $25k
     # this is needed because we can always buy, but selling gets restricted if we hit the limit
     # so we should prevent the order from going through so that we're not in a position where we can't sell
-    account = client.get_account()
-    if account.daytrade_count >= 3 and float(account.equity) < 25_000:
-        return JSONResponse(content={"error": "Pattern day trader"}, status_code=status.HTTP_429_TOO_MANY_REQUESTS)
+    if account.daytrade_count >= 3 and account.equity < 25_000:
+        return ORJSONResponse(content={"error": "Pattern day trader"}, status_code=status.HTTP_429_TOO_MANY_REQUESTS)
 
-    position = get_current_position(client, order.ticker)
     # if we don't hold the position, simply long or short the position
     if not position:
         if order.max_slippage > 0:
             # do a slippage check
-            quote = get_latest_quote(order.ticker, order.asset_class)
+            quote = await get_cached_quote(order.ticker, order.asset_class)
             # if we are selling (shorting), use bid
             # if we are buying (longing), use ask
             price = quote.bid_price if order.action == "sell" else quote.ask_price
             # get the absolute value of the slippage
             slippage = abs((price - order.price) / order.price)
             if slippage > order.max_slippage:
-                return JSONResponse(content={"error": "Slippage too high"}, status_code=status.HTTP_412_PRECONDITION_FAILED)
+                return ORJSONResponse(content={"error": "Slippage too high"}, status_code=status.HTTP_412_PRECONDITION_FAILED)
 
-        new_order = exec_trade(client, order, extended_hours)
+        new_order = await exec_trade(client, order, extended_hours, account=account)
         order.order_id = str(new_order.id)
-        session.commit()
-        session.refresh(order)
+        # the order was already logged above, recording the Alpaca ID can wait until after the response
+        background_task.add_task(save, session, order)
         background_task.add_task(background_snapshot, session=session)
         return order
     else:
@@ -173,12 +194,14 @@ async def webhook(name: str, order: Order, session: SessionDep, req: Request, ba
                 background_task.add_task(background_snapshot, session=session)
                 return order
             # at this point, we have to close the position and open a new one regardless of the market position
-            close_position(client, order.ticker, wait_for_fill=True)
+            await close_position(client, order.ticker, wait_for_fill=True)
+            # closing the position changes our buying power, so exec_trade has to fetch the account again
+            account = None
         # once the existing position is closed, we can open a new one
-        new_order = exec_trade(client, order, extended_hours)
+        new_order = await exec_trade(client, order, extended_hours, account=account)
         order.order_id = str(new_order.id)
-        session.commit()
-        session.refresh(order)
+        # the order was already logged above, recording the Alpaca ID can wait until after the response
+        background_task.add_task(save, session, order)
         background_task.add_task(background_snapshot, session=session)
         return order
 
@@ -1,4 +1,7 @@
+from alpaca.trading.enums import OrderStatus
+
 from lib.env_vars import IP_WHITELIST
+from lib.ip_whitelist import IPWhitelist
 
 # most of these IPs are from TradingView
 # https://www.tradingview.com/support/solutions/43000529348-about-webhooks/
@@ -12,6 +15,21 @@ ips = [
     'localhost'
 ]
 
-WHITELIST = ips + IP_WHITELIST
+# entries may be bare addresses or CIDR blocks
+WHITELIST = IPWhitelist(ips + IP_WHITELIST)
 
 ORIGINS = ['*']
+
+FINISHED_STATUSES = frozenset({OrderStatus.FILLED, OrderStatus.CANCELED,
+                               OrderStatus.EXPIRED, OrderStatus.DONE_FOR_DAY})
+
+# maximum number of seconds to wait for an order to fill
+MAX_WAIT = 30.0
+
+# number of seconds a market clock response is reused before asking Alpaca again
+CLOCK_TTL = 5.0
+
+# number of seconds a quote is shared between slippage checks for the same ticker
+QUOTE_TTL = 0.5
+# maximum number of tickers kept in the quote cache
+QUOTE_CACHE_SIZE = 512
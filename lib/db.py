@@ -1,6 +1,9 @@
 from typing import Optional
 from datetime import datetime
 
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import Index, event, insert
+from sqlalchemy.orm import make_transient_to_detached
 from sqlmodel import Field, Session, SQLModel, create_engine
 
 from lib.env_vars import DB_URI, DB_ECHO
@@ -8,6 +11,8 @@ from lib.env_vars import DB_URI, DB_ECHO
 
 class AccountSnapshot(SQLModel, table=True):
     '''AccountSnapshot model for the database. Represents a snapshot of an account's equity and cash at a given time. Can be read from the API and doubles as a response model.'''
+    # backs the latest-snapshots-per-account query
+    __table_args__ = (Index("ix_snap_name_created", "name", "created_at"),)
     id: Optional[int] = Field(default=None, primary_key=True)
     account_id: str
     name: str
@@ -50,14 +55,57 @@ class Order(SQLModel, table=True):
 
 connect_args = {"check_same_thread": False} if DB_URI.startswith('sqlite') else {
 }
-engine = create_engine(DB_URI, echo=DB_ECHO, connect_args=connect_args)
+# blocking DB work is run in the threadpool, so size the pool to match concurrent requests
+pool_args = {} if DB_URI.startswith('sqlite') else {
+    "pool_size": 20, "max_overflow": 10, "pool_pre_ping": True}
+engine = create_engine(DB_URI, echo=DB_ECHO,
+                       connect_args=connect_args, **pool_args)
+
+
+if DB_URI.startswith('sqlite'):
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        '''Switches SQLite to write-ahead logging so readers don't block on the writer, and only fsyncs at checkpoints.'''
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
 
 
 def create_db_and_tables():
     '''Creates the database and tables if they don't exist.'''
     SQLModel.metadata.create_all(engine)
+    # create_all skips tables that already exist, so add any indexes missing from older databases
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
 
 
 def get_session():
     with Session(engine) as session:
         yield session
+
+
+async def save(session: Session, *instances: SQLModel):
+    '''Adds, commits, and refreshes the given instances in the threadpool so the event loop isn't blocked on the database.'''
+    def _save():
+        for instance in instances:
+            session.add(instance)
+        session.commit()
+        for instance in instances:
+            session.refresh(instance)
+    await run_in_threadpool(_save)
+
+
+async def insert_row(session: Session, instance: SQLModel):
+    '''Inserts a new row with a single INSERT ... RETURNING and sets its primary key, instead of an ORM flush followed by a refresh.
+The instance is attached to the session afterwards, so later changes to it are saved as updates.'''
+    def _insert_row():
+        model = type(instance)
+        statement = insert(model).values(
+            **instance.model_dump(exclude={"id"})).returning(model.id)
+        instance.id = session.execute(statement).scalar_one()
+        session.commit()
+        make_transient_to_detached(instance)
+        session.add(instance)
+    await run_in_threadpool(_insert_row)
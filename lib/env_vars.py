@@ -1,4 +1,5 @@
 import os
+from functools import cache
 
 from pydantic import BaseModel
 from dotenv import load_dotenv
@@ -12,6 +13,8 @@ DB_URI = os.getenv("DB_URI", "sqlite:///trader.db")
 # if TEST_MODE is set, don't execute trades and only log them
 TEST_MODE = os.getenv("TEST_MODE", "False") == "True"
 DB_ECHO = os.getenv("DB_ECHO", "False") == "True"
+# if ORDER_STREAMS is disabled, wait for order fills by polling the REST API only
+ORDER_STREAMS = os.getenv("ORDER_STREAMS", "True") == "True"
 
 # list variables
 # ALPACA_API_KEYS, ALPACA_API_SECRETS, and ALPACA_NAMES are all comma-separated strings
@@ -37,8 +40,10 @@ class AlpacaCreds(BaseModel):
     paper: bool
 
 
+@cache
 def get_accounts() -> dict[str, AlpacaCreds]:
-    '''Returns a dictionary using the name as the key and the AlpacaCreds object as the value.'''
+    '''Returns a dictionary using the name as the key and the AlpacaCreds object as the value.
+The accounts are built once from the environment and the same dictionary is returned on every call, so it must not be modified.'''
     accounts = {}
     for key, secret, name, paper in zip(ALPACA_API_KEYS, ALPACA_API_SECRETS, ALPACA_NAMES, ALPACA_PAPER):
         accounts[name] = AlpacaCreds(
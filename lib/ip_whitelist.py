@@ -0,0 +1,62 @@
+import socket
+import ipaddress
+
+_IPV4_MAPPED_PREFIX = bytes(10) + b'\xff\xff'
+
+
+def parse_ip(ip: str) -> tuple[int, int] | None:
+    '''Parses an IP address into a (version, integer value) tuple using the C inet_pton, or returns None if it isn't an IP address.
+IPv4-mapped IPv6 addresses are returned as IPv4.'''
+    try:
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+    except OSError:
+        pass
+    try:
+        packed = socket.inet_pton(socket.AF_INET6, ip)
+    except OSError:
+        return None
+    # IPv4 clients behind a dual-stack proxy show up as ::ffff:a.b.c.d
+    if packed.startswith(_IPV4_MAPPED_PREFIX):
+        return 4, int.from_bytes(packed[12:], 'big')
+    return 6, int.from_bytes(packed, 'big')
+
+
+class IPWhitelist:
+    '''Set of allowed IP addresses and CIDR networks. Bare addresses are stored as /32 (or /128 for IPv6) networks.
+Lookups mask the address once per configured prefix length and probe a set, so the cost depends on the number of distinct prefix lengths rather than the number of entries.'''
+
+    def __init__(self, entries: list[str] = []):
+        # non-IP entries such as 'localhost' are matched verbatim
+        self._hosts: set[str] = set()
+        # (ip version, prefix length) -> (netmask, set of network addresses) as ints
+        self._networks: dict[tuple[int, int], tuple[int, set[int]]] = {}
+        for entry in entries:
+            self.add(entry)
+
+    def add(self, entry: str):
+        try:
+            network = ipaddress.ip_network(entry, strict=False)
+        except ValueError:
+            self._hosts.add(entry)
+            return
+        # store IPv4-mapped entries as IPv4 to match how addresses are looked up
+        mapped = network.version == 6 and network.network_address.ipv4_mapped
+        if mapped and network.prefixlen >= 96:
+            network = ipaddress.ip_network(
+                f'{mapped}/{network.prefixlen - 96}')
+        key = (network.version, network.prefixlen)
+        if key not in self._networks:
+            self._networks[key] = (int(network.netmask), set())
+        self._networks[key][1].add(int(network.network_address))
+
+    def __contains__(self, ip: str) -> bool:
+        if ip in self._hosts:
+            return True
+        parsed = parse_ip(ip)
+        if parsed is None:
+            return False
+        version, value = parsed
+        for (network_version, _), (netmask, networks) in self._networks.items():
+            if network_version == version and value & netmask in networks:
+                return True
+        return False
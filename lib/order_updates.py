@@ -0,0 +1,117 @@
+import time
+import random
+import asyncio
+import logging
+
+from alpaca.trading import Order as AlpacaOrder
+from alpaca.trading.client import TradingClient
+from alpaca.trading.models import TradeUpdate
+from alpaca.trading.stream import TradingStream
+from fastapi.concurrency import run_in_threadpool
+
+from lib.constants import FINISHED_STATUSES, MAX_WAIT
+from lib.env_vars import get_accounts
+
+log = logging.getLogger(__name__)
+
+_STREAMS: list[TradingStream] = []
+_STREAM_TASKS: list[asyncio.Task] = []
+# order ID -> future resolved with the order once it reaches a finished status
+_ORDER_FUTURES: dict[str, asyncio.Future] = {}
+
+# backoff for polling the REST API while waiting for an order, with or without the stream.
+# most orders fill within a few hundred milliseconds, so start fast and slow down for the stragglers
+POLL_INITIAL_DELAY = 0.05
+POLL_BACKOFF = 1.6
+POLL_MAX_DELAY = 1.0
+
+# backoff between reconnect attempts, so bad credentials or an outage don't spin the event loop
+STREAM_RETRY_INITIAL_DELAY = 1.0
+STREAM_RETRY_MAX_DELAY = 60.0
+
+
+async def _on_trade_update(update: TradeUpdate):
+    order = update.order
+    if order.status not in FINISHED_STATUSES:
+        return
+    future = _ORDER_FUTURES.pop(str(order.id), None)
+    if future and not future.done():
+        future.set_result(order)
+
+
+async def _run_stream(name: str, stream: TradingStream):
+    '''Keeps the stream connected, reconnecting with exponential backoff.
+Used instead of TradingStream.run(), which starts its own event loop and retries failed connections every 10ms.'''
+    delay = STREAM_RETRY_INITIAL_DELAY
+    while True:
+        try:
+            # connects, authenticates, and subscribes to trade updates
+            await stream._start_ws()
+            delay = STREAM_RETRY_INITIAL_DELAY
+            await stream._consume()
+        except Exception as e:
+            log.warning("Trade updates stream for '%s' failed, reconnecting in %.0fs: %s",
+                        name, delay, e)
+        await stream.close()
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, STREAM_RETRY_MAX_DELAY)
+
+
+def start_order_streams():
+    '''Subscribes to the trade updates websocket for every account. Must be called from within the running event loop.'''
+    for name, creds in get_accounts().items():
+        stream = TradingStream(
+            creds.api_key, creds.api_secret, paper=creds.paper)
+        stream.subscribe_trade_updates(_on_trade_update)
+        _STREAMS.append(stream)
+        _STREAM_TASKS.append(asyncio.create_task(_run_stream(name, stream)))
+
+
+async def stop_order_streams():
+    '''Closes the trade updates websockets started by start_order_streams.'''
+    for task in _STREAM_TASKS:
+        task.cancel()
+    await asyncio.gather(*_STREAM_TASKS, return_exceptions=True)
+    for stream in _STREAMS:
+        await stream.close()
+    _STREAMS.clear()
+    _STREAM_TASKS.clear()
+
+
+async def _poll_order(client: TradingClient, order: AlpacaOrder, timeout: float, update: asyncio.Future | None = None) -> AlpacaOrder:
+    deadline = time.monotonic() + timeout
+    delay = POLL_INITIAL_DELAY
+    while order.status not in FINISHED_STATUSES:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        # jitter keeps concurrent waiters from polling in lockstep
+        wait = min(delay * random.uniform(0.8, 1.2), remaining)
+        if update is None:
+            await asyncio.sleep(wait)
+        else:
+            # wake early if the stream reports the order finished
+            done, _ = await asyncio.wait({update}, timeout=wait)
+            if done:
+                return update.result()
+        delay = min(delay * POLL_BACKOFF, POLL_MAX_DELAY)
+        order = await run_in_threadpool(client.get_order_by_id, order.id)
+    return order
+
+
+async def wait_for_order(client: TradingClient, order: AlpacaOrder, timeout: float = MAX_WAIT) -> AlpacaOrder:
+    '''Waits for the order to reach a finished status or for the timeout to expire, then returns the latest copy of the order.
+Polls the REST API with backoff, and returns as soon as the trade updates stream reports the order finished when it is running.
+Polling continues alongside the stream so a disconnected or silent stream can't hold up a fill.'''
+    if order.status in FINISHED_STATUSES:
+        return order
+    if not _STREAMS:
+        return await _poll_order(client, order, timeout)
+
+    order_id = str(order.id)
+    future = asyncio.get_running_loop().create_future()
+    _ORDER_FUTURES[order_id] = future
+    try:
+        return await _poll_order(client, order, timeout, future)
+    finally:
+        _ORDER_FUTURES.pop(order_id, None)
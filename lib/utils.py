@@ -1,75 +1,162 @@
 import time
-import math
-import random
+import asyncio
+import itertools
+import threading
+from dataclasses import dataclass
+from decimal import Decimal
 from typing import Literal
 
 from alpaca.broker import StopOrderRequest
 from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
 from alpaca.data import Quote
 from alpaca.data.historical import StockHistoricalDataClient, CryptoHistoricalDataClient
 from alpaca.data.requests import StockLatestQuoteRequest, CryptoLatestQuoteRequest
-from alpaca.trading import Position, Order as AlpacaOrder
+from alpaca.trading import Position, Order as AlpacaOrder, Clock, TradeAccount
 from alpaca.trading.client import TradingClient
 from alpaca.trading.enums import (
     OrderSide, TimeInForce, OrderStatus, OrderClass)
 from alpaca.trading.requests import (
     StopLimitOrderRequest, LimitOrderRequest, MarketOrderRequest, ClosePositionRequest, TakeProfitRequest, StopLossRequest, TrailingStopOrderRequest)
 
+from lib.constants import CLOCK_TTL, QUOTE_TTL, QUOTE_CACHE_SIZE
 from lib.db import Order
 from lib.env_vars import get_accounts, get_account
-
-FINISHED_STATUSES = [OrderStatus.FILLED, OrderStatus.CANCELED,
-                     OrderStatus.EXPIRED, OrderStatus.DONE_FOR_DAY]
-
-MAX_WAIT = 30.0
+from lib.order_updates import wait_for_order
+
+# clients are reused for the lifetime of the process so their HTTP sessions
+# (and the underlying keep-alive connections) are shared across requests
+_CLIENT_CACHE: dict[str, TradingClient] = {}
+_DATA_CLIENT_CACHE: dict[tuple[str, str], StockHistoricalDataClient | CryptoHistoricalDataClient] = {}
+_CLIENT_LOCK = threading.Lock()
+# (expiry as a monotonic timestamp, clock). The market clock is the same for every account,
+# so one cached response serves them all
+_CLOCK_CACHE: tuple[float, Clock] | None = None
+# round-robin over account names for market data requests
+_QUOTE_ACCOUNTS = itertools.cycle(get_accounts())
+# (ticker, asset class) -> (QUOTE_TTL window number, quote request), oldest window first
+_QUOTE_CACHE: dict[tuple[str, str], tuple[int, asyncio.Future]] = {}
+
+# headers that may carry the real client IP, in order of priority.
+# ASGI header names are lowercase bytes, so they can be matched against the raw headers directly
+_IP_HEADERS = (
+    b'x-forwarded-for',
+    b'cf-connecting-ip',
+    b'true-client-ip',
+    b'x-client-ip',
+    b'x-cluster-client-ip',
+    b'x-forwarded',
+    b'forwarded-for',
+    b'forwarded',
+    b'x-forwarded-host',
+    b'x-real-ip',
+    b'fly-client-ip',
+)
+_IP_HEADER_PRIORITY = {name: i for i, name in enumerate(_IP_HEADERS)}
+
+
+@dataclass(slots=True)
+class AccountView:
+    '''The account fields needed to place a trade, parsed to numbers once per request.'''
+    buying_power: float
+    non_marginable_buying_power: float
+    equity: float
+    daytrade_count: int
+
+    @classmethod
+    def from_alpaca(cls, account: TradeAccount):
+        return cls(
+            buying_power=float(account.buying_power),
+            non_marginable_buying_power=float(
+                account.non_marginable_buying_power),
+            equity=float(account.equity),
+            daytrade_count=account.daytrade_count,
+        )
 
 
 def get_client_ip(request: Request) -> str | list[str]:
     '''Checks for the real client IP address in the request headers from a number of common sources.'''
-    headers = [
-        'X-Forwarded-For',
-        'CF-Connecting-IP',
-        'True-Client-IP',
-        'X-Client-IP',
-        'X-Cluster-Client-IP',
-        'X-Forwarded',
-        'Forwarded-For',
-        'Forwarded',
-        'X-Forwarded-Host',
-        'X-Real-IP',
-        'Fly-Client-IP'
-    ]
-    for header in headers:
-        ip = request.headers.get(header)
-        # if there is a comma in the header, it is a list of IPs
-        if ip and ',' in ip:
-            return [x.strip() for x in ip.split(',')]
-        if ip:
-            return ip
-
-    return request.client.host
+    # one pass over the raw headers, keeping the highest priority match
+    match = None
+    match_priority = len(_IP_HEADER_PRIORITY)
+    for name, value in request.headers.raw:
+        priority = _IP_HEADER_PRIORITY.get(name, match_priority)
+        if priority < match_priority and value:
+            match, match_priority = value, priority
+            if priority == 0:
+                break
+
+    if match is None:
+        return request.client.host
+
+    ip = match.decode('latin-1')
+    # if there is a comma in the header, it is a list of IPs
+    if ',' in ip:
+        return [x.strip() for x in ip.split(',')]
+    return ip
 
 
 def get_trading_clients() -> dict[str, TradingClient]:
     '''Returns a dictionary using the name as the key and the TradingClient object as the value.'''
-    accounts = get_accounts()
-    clients = {}
-    for name, creds in accounts.items():
-        clients[name] = TradingClient(
-            creds.api_key, creds.api_secret, paper=creds.paper)
-    return clients
+    return {name: get_trading_client(name) for name in get_accounts()}
 
 
 def get_trading_client(name: str) -> TradingClient | None:
+    '''Returns the cached TradingClient for the given account name, creating it on first use.'''
+    client = _CLIENT_CACHE.get(name)
+    if client:
+        return client
     creds = get_account(name)
     if not creds:
         return None
-    return TradingClient(creds.api_key, creds.api_secret, paper=creds.paper)
-
-
-def is_extended_hours(client: TradingClient) -> bool:
+    with _CLIENT_LOCK:
+        client = _CLIENT_CACHE.get(name)
+        if not client:
+            client = TradingClient(
+                creds.api_key, creds.api_secret, paper=creds.paper)
+            _CLIENT_CACHE[name] = client
+    return client
+
+
+def get_data_client(name: str, asset_class: Literal["stock", "crypto"] = "stock") -> StockHistoricalDataClient | CryptoHistoricalDataClient | None:
+    '''Returns the cached historical data client for the given account name and asset class, creating it on first use.'''
+    key = (name, asset_class)
+    client = _DATA_CLIENT_CACHE.get(key)
+    if client:
+        return client
+    creds = get_account(name)
+    if not creds:
+        return None
+    client_class = CryptoHistoricalDataClient if asset_class == "crypto" else StockHistoricalDataClient
+    with _CLIENT_LOCK:
+        client = _DATA_CLIENT_CACHE.get(key)
+        if not client:
+            client = client_class(
+                creds.api_key, creds.api_secret, paper=creds.paper)
+            _DATA_CLIENT_CACHE[key] = client
+    return client
+
+
+async def get_account_view(client: TradingClient) -> AccountView:
+    '''Fetches the account from Alpaca and returns it as an AccountView.'''
+    account = await run_in_threadpool(client.get_account)
+    return AccountView.from_alpaca(account)
+
+
+async def get_clock(client: TradingClient) -> Clock:
+    '''Returns the market clock, reusing the previous response from any account for CLOCK_TTL seconds.'''
+    global _CLOCK_CACHE
+    now = time.monotonic()
+    if _CLOCK_CACHE and _CLOCK_CACHE[0] > now:
+        return _CLOCK_CACHE[1]
+    clock = await run_in_threadpool(client.get_clock)
+    _CLOCK_CACHE = (now + CLOCK_TTL, clock)
+    return clock
+
+
+async def is_extended_hours(client: TradingClient) -> bool:
     '''Returns true if the market is closed but extended hours are active.'''
-    clock = client.get_clock()
+    clock = await get_clock(client)
     if clock.is_open:
         return False
 
@@ -78,50 +165,40 @@ def is_extended_hours(client: TradingClient) -> bool:
     return current_time.hour < 20 and current_time.hour >= 4
 
 
-def can_trade(client: TradingClient) -> bool:
+async def can_trade(client: TradingClient) -> bool:
     '''Returns true if the market is open or extended hours are active.'''
-    clock = client.get_clock()
-    return clock.is_open or is_extended_hours(client)
+    clock = await get_clock(client)
+    return clock.is_open or await is_extended_hours(client)
 
 
-def exec_trade(client: TradingClient, order: Order, extended_hours: bool = False, wait_for_fill: bool = False) -> AlpacaOrder:
-    account = client.get_account()
+async def exec_trade(client: TradingClient, order: Order, extended_hours: bool = False, wait_for_fill: bool = False, account: AccountView | None = None) -> AlpacaOrder:
+    # callers that already fetched the account can pass it in to save a round trip
+    if account is None:
+        account = await get_account_view(client)
     # we're doing notional orders, but we need to know how much.
     # If its a stock and not leveraged, get our regular buying power and multiply by the percentage
     # If its a stock and leveraged or crypto, get our non marginable buying power and multiply by the percentage
-    buying_power = float(account.buying_power)
+    buying_power = account.buying_power
     if order.leveraged or order.asset_class == "crypto":
-        buying_power = float(account.non_marginable_buying_power)
+        buying_power = account.non_marginable_buying_power
 
     # cannot have more than 2 decimal places
     notional = round(buying_power * order.buying_power_pct, 2)
     # if we're doing limit orders, we'll need this.
-    qty = math.floor(notional / order.price)
+    # divide as decimals so values like 100.00 / 0.10 don't floor to one share short
+    qty = int(Decimal(str(notional)) // Decimal(str(order.price)))
 
     # if the value is less than a dollar, we can't trade. Throw bad request
     if notional < 1:
         raise Exception("Notional value is less than $1. Cannot trade.")
 
-    order_req = MarketOrderRequest(
-        symbol=order.ticker,
-        qty=qty,
-        time_in_force=TimeInForce.DAY if not order.asset_class == "crypto" else TimeInForce.GTC,
-        side=OrderSide.BUY if order.action == "buy" else OrderSide.SELL,
-    )
+    side = OrderSide.BUY if order.action == "buy" else OrderSide.SELL
+    time_in_force = TimeInForce.GTC if order.asset_class == "crypto" else TimeInForce.DAY
 
     # if we are doing a limit order, we can't do fractional shares
-    if order.trailing_stop or order.sl or order.tp:
-        # get the quantity of shares we can buy
-        if qty < 1:
-            raise Exception(
-                "Limit orders must have a integer quantity greater than 0.")
-        # still just a standard market order, just using qty instead of notional
-        order_req = MarketOrderRequest(
-            symbol=order.ticker,
-            qty=qty,
-            time_in_force=TimeInForce.DAY if not order.asset_class == "crypto" else TimeInForce.GTC,
-            side=OrderSide.BUY if order.action == "buy" else OrderSide.SELL,
-        )
+    if (order.trailing_stop or order.sl or order.tp) and qty < 1:
+        raise Exception(
+            "Limit orders must have a integer quantity greater than 0.")
 
     # need to finish the logic for sl, tp, and trailing_sl
     # if we have both, we need to use a bracket order
@@ -131,27 +208,7 @@ def exec_trade(client: TradingClient, order: Order, extended_hours: bool = False
     # if we only have sl, we need to use a stop limit order
     # if we only have tp, we need to use a limit order
     # TODO properly implement and test this logic
-    if not extended_hours:
-        if order.tp and order.sl:
-            if qty < 1:
-                raise Exception(
-                    "Limit orders must have a integer quantity greater than 0.")
-            stop_price = round(order.price * (1 - order.sl), 2)
-            limit_price = round(order.price * (1 + order.tp), 2)
-            stop_loss = StopLossRequest(stop_price=stop_price)
-            take_profit = TakeProfitRequest(limit_price=limit_price)
-            order_req = MarketOrderRequest(
-                symbol=order.ticker,
-                qty=qty,
-                time_in_force=TimeInForce.GTC,
-                side=OrderSide.BUY if order.action == "buy" else OrderSide.SELL,
-                stop_loss=stop_loss,
-                take_profit=take_profit,
-                order_class=OrderClass.BRACKET
-            )
-
     if extended_hours and order.asset_class != "crypto":
-        qty = math.floor(notional / order.price)
         if qty < 1:
             raise Exception(
                 "Limit orders must have a integer quantity greater than 0.")
@@ -160,9 +217,29 @@ def exec_trade(client: TradingClient, order: Order, extended_hours: bool = False
             symbol=order.ticker,
             qty=qty,
             time_in_force=TimeInForce.DAY,
-            side=OrderSide.BUY if order.action == "buy" else OrderSide.SELL,
+            side=side,
             limit_price=order.high or order.price,
         )
+    elif not extended_hours and order.tp and order.sl:
+        stop_price = round(order.price * (1 - order.sl), 2)
+        limit_price = round(order.price * (1 + order.tp), 2)
+        order_req = MarketOrderRequest(
+            symbol=order.ticker,
+            qty=qty,
+            time_in_force=TimeInForce.GTC,
+            side=side,
+            stop_loss=StopLossRequest(stop_price=stop_price),
+            take_profit=TakeProfitRequest(limit_price=limit_price),
+            order_class=OrderClass.BRACKET
+        )
+    else:
+        # still just a standard market order, just using qty instead of notional
+        order_req = MarketOrderRequest(
+            symbol=order.ticker,
+            qty=qty,
+            time_in_force=time_in_force,
+            side=side,
+        )
 
     # if we have a stop loss, take profit, or trailing stop, we need to create a separate order
     # However this shouldn't execute if the order request is a bracket order or its a sell order
@@ -172,26 +249,21 @@ def exec_trade(client: TradingClient, order: Order, extended_hours: bool = False
         try:
             if order.sl or order.tp or order.trailing_stop:
                 # first we need to create the initial order and wait for it to fill
-                alpaca_order = client.submit_order(order_req)
-                start = time.time()
-                while alpaca_order.status not in FINISHED_STATUSES:
-                    if alpaca_order.status != OrderStatus.NEW:
-                        time.sleep(0.25)
-                    alpaca_order = client.get_order_by_id(alpaca_order.id)
-                    if time.time() - start >= MAX_WAIT:
-                        break
+                alpaca_order = await run_in_threadpool(client.submit_order, order_req)
+                alpaca_order = await wait_for_order(client, alpaca_order)
                 # if the order is not filled, we need to cancel it and return
                 if alpaca_order.status != OrderStatus.FILLED:
-                    client.cancel_order_by_id(alpaca_order.id)
+                    await run_in_threadpool(client.cancel_order_by_id, alpaca_order.id)
                     alpaca_order.status = OrderStatus.CANCELED
                     return alpaca_order
 
                 # now is the logic for the rest of the orders
                 # we will overwrite the order_req with the new order and let the logic continue
                 # we'll start with the stop loss
+                filled_avg_price = float(alpaca_order.filled_avg_price)
                 if order.sl:
                     stop_price = round(
-                        float(alpaca_order.filled_avg_price) * (1 - order.sl), 2)
+                        filled_avg_price * (1 - order.sl), 2)
                     order_req = StopOrderRequest(
                         symbol=alpaca_order.symbol,
                         qty=alpaca_order.filled_qty,
@@ -201,9 +273,9 @@ def exec_trade(client: TradingClient, order: Order, extended_hours: bool = False
                     )
                 elif order.tp:
                     limit_price = round(
-                        float(alpaca_order.filled_avg_price) * (1 + order.tp), 2)
+                        filled_avg_price * (1 + order.tp), 2)
                     stop_price = round(
-                        float(alpaca_order.filled_avg_price) * (1 - order.tp), 2)
+                        filled_avg_price * (1 - order.tp), 2)
                     order_req = StopLimitOrderRequest(
                         symbol=alpaca_order.symbol,
                         qty=alpaca_order.filled_qty,
@@ -230,15 +302,15 @@ def exec_trade(client: TradingClient, order: Order, extended_hours: bool = False
             # if the order is partially filled, cancel it and create a market sell order
             # otherwise just raise the error
             if alpaca_order.status == OrderStatus.FILLED:
-                client.submit_order(MarketOrderRequest(
+                await run_in_threadpool(client.submit_order, MarketOrderRequest(
                     symbol=alpaca_order.symbol,
                     qty=alpaca_order.filled_qty,
                     time_in_force=TimeInForce.GTC,
                     side=OrderSide.SELL,
                 ))
             elif alpaca_order.status == OrderStatus.PARTIALLY_FILLED:
-                client.cancel_order_by_id(alpaca_order.id)
-                client.submit_order(MarketOrderRequest(
+                await run_in_threadpool(client.cancel_order_by_id, alpaca_order.id)
+                await run_in_threadpool(client.submit_order, MarketOrderRequest(
                     symbol=alpaca_order.symbol,
                     qty=alpaca_order.filled_qty,
                     time_in_force=TimeInForce.GTC,
@@ -248,63 +320,70 @@ def exec_trade(client: TradingClient, order: Order, extended_hours: bool = False
             raise e
 
     if not wait_for_fill:
-        return client.submit_order(order_req)
-
-    alpaca_order = client.submit_order(order_req)
-
-    start = time.time()
-    while alpaca_order.status not in FINISHED_STATUSES:
-        if alpaca_order.status != OrderStatus.NEW:
-            time.sleep(0.25)
-        alpaca_order = client.get_order_by_id(alpaca_order.id)
-        if time.time() - start >= MAX_WAIT:
-            break
+        return await run_in_threadpool(client.submit_order, order_req)
 
-    return alpaca_order
+    alpaca_order = await run_in_threadpool(client.submit_order, order_req)
+    return await wait_for_order(client, alpaca_order)
 
 
-def get_current_position(client: TradingClient, ticker: str) -> Position | None:
+async def get_current_position(client: TradingClient, ticker: str) -> Position | None:
     position = None
     try:
-        position = client.get_open_position(ticker)
+        position = await run_in_threadpool(client.get_open_position, ticker)
     except Exception as e:
         pass
     return position
 
 
-def close_position(client: TradingClient, ticker: str, percentage: float = 100.0, wait_for_fill: bool = False) -> AlpacaOrder | None:
+async def close_position(client: TradingClient, ticker: str, percentage: float = 100.0, wait_for_fill: bool = False) -> AlpacaOrder | None:
     position = None
     try:
-        position = client.close_position(ticker, ClosePositionRequest(
+        position = await run_in_threadpool(client.close_position, ticker, ClosePositionRequest(
             percentage=percentage
         ))
         if wait_for_fill:
-            start = time.time()
-            while position.status not in FINISHED_STATUSES:
-                if position.status != OrderStatus.NEW:
-                    time.sleep(0.25)
-                position = client.get_order_by_id(position.id)
-                if time.time() - start >= MAX_WAIT:
-                    break
+            position = await wait_for_order(client, position)
     except Exception as e:
         pass
     return position
 
 
-def get_latest_quote(ticker: str, asset_class: Literal["stock", "crypto"] = "stock") -> Quote:
+async def get_latest_quote(ticker: str, asset_class: Literal["stock", "crypto"] = "stock") -> Quote:
     '''Returns the latest quote for the given ticker. If the asset class is crypto, it will use the CryptoHistoricalDataClient, otherwise it will use the StockHistoricalDataClient.'''
-    accounts = list(get_accounts().values())
-    random_account = random.choice(accounts)
-
+    # spread quote requests across the accounts' rate limits
+    client = get_data_client(next(_QUOTE_ACCOUNTS), asset_class)
     if asset_class == "crypto":
-        client = CryptoHistoricalDataClient(
-            random_account.api_key, random_account.api_secret, paper=random_account.paper)
-        resp = client.get_crypto_latest_quote(
-            CryptoLatestQuoteRequest(symbol_or_symbols=ticker))
+        resp = await run_in_threadpool(client.get_crypto_latest_quote,
+                                       CryptoLatestQuoteRequest(symbol_or_symbols=ticker))
         return resp[ticker]
 
-    client = StockHistoricalDataClient(
-        random_account.api_key, random_account.api_secret, paper=random_account.paper)
-    resp = client.get_stock_latest_quote(
-        StockLatestQuoteRequest(symbol_or_symbols=ticker))
+    resp = await run_in_threadpool(client.get_stock_latest_quote,
+                                   StockLatestQuoteRequest(symbol_or_symbols=ticker))
     return resp[ticker]
+
+
+async def get_cached_quote(ticker: str, asset_class: Literal["stock", "crypto"] = "stock") -> Quote:
+    '''Returns the latest quote for the given ticker. Callers within the same QUOTE_TTL window share a single request.'''
+    key = (ticker, asset_class)
+    window = int(time.monotonic() / QUOTE_TTL)
+    cached = _QUOTE_CACHE.get(key)
+    if cached and cached[0] == window:
+        request = cached[1]
+    else:
+        request = asyncio.ensure_future(get_latest_quote(ticker, asset_class))
+        # mark the exception as retrieved in case every caller is cancelled before it finishes
+        request.add_done_callback(
+            lambda future: future.cancelled() or future.exception())
+        # re-insert so the dict stays ordered by window, then evict the oldest tickers
+        _QUOTE_CACHE.pop(key, None)
+        _QUOTE_CACHE[key] = (window, request)
+        while len(_QUOTE_CACHE) > QUOTE_CACHE_SIZE:
+            del _QUOTE_CACHE[next(iter(_QUOTE_CACHE))]
+    try:
+        # shield the shared request so one caller being cancelled doesn't cancel it for the others
+        return await asyncio.shield(request)
+    except Exception:
+        # don't keep serving a failed request for the rest of the window
+        if _QUOTE_CACHE.get(key, (None, None))[1] is request:
+            del _QUOTE_CACHE[key]
+        raise